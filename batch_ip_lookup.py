@@ -3,96 +3,156 @@
 """
 Пакетная обработка IP-lookup:
   1. Читает домены из .txt или .json (можно с полными URL)
-  2. Очищает их до чистого домена
-  3. Выполняет параллельные запросы через ThreadPoolExecutor
+  2. Очищает их до чистого домена, убирает дубликаты и резолвит в IP
+  3. Выполняет пакетные запросы к ip-api.com/batch через ThreadPoolExecutor
   4. Сохраняет результат в CSV в папке results
   5. Отправляет уведомление и файл в Telegram (по настройкам)
   6. Логирует старт, прогресс и ошибки
 """
 import argparse
+import csv
 import json
 import logging
+import re
 import sys
 import uuid
 from datetime import datetime
 from pathlib import Path
-from typing import List, Dict, Optional
+from typing import Dict, Iterator, List, Optional
 from urllib.parse import urlparse
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache, partial
 
-import pandas as pd
 import requests
-from requests.adapters import HTTPAdapter
-from requests.packages.urllib3.util.retry import Retry
 import os
+import socket
 import threading
 
+from src.script.reqapi import IA_BATCH_MAX_SIZE, reqapi
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+try:
+    from requests_toolbelt.multipart.encoder import MultipartEncoder
+except ImportError:
+    MultipartEncoder = None
+
 # ---------------------------------------------------
 # Настройки для Telegram: рекомендую задавать через переменные окружения
 TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN', '')
 TELEGRAM_CHAT_ID = os.getenv('TELEGRAM_CHAT_ID', '')
-DEFAULT_WORKERS = 3
+DEFAULT_WORKERS = 10  # упирается в rate-limit ip-api, а не в пул соединений
+RESOLVE_WORKERS = 32  # DNS не ограничен rate-limit ip-api, можно шире
 RESULTS_DIR = Path('results')
 LOG_FORMAT = '%(asctime)s [%(levelname)s] [%(threadName)s] %(message)s'
 LOG_LEVEL = logging.DEBUG
-CHUNK_SIZE = 100
+# Тела ответов API в DEBUG дорого форматировать на каждый batch; включать при отладке
+REQAPI_LOG_LEVEL = logging.INFO
+JSON_STREAM_MIN_BYTES = 64 * 1024 * 1024
+CHUNK_SIZE = IA_BATCH_MAX_SIZE  # один чанк — один POST к ip-api.com/batch
+CSV_FIELDS = ['domain', 'country', 'isp', 'organization', 'as']
 # ---------------------------------------------------
 
+_DOMAIN_RE = re.compile(r'^(?:[a-z][a-z0-9+.-]*://)?([^/:?#\s]+)', re.I)
+
 
 class DomainReader:
     """Читает и очищает список доменов из .txt или .json файлов"""
 
     @staticmethod
     def read(path: Path) -> List[str]:
-        text = path.read_text(encoding='utf-8')
-        if path.suffix.lower() == '.txt':
-            items = [line.strip() for line in text.splitlines() if line.strip()]
-        elif path.suffix.lower() == '.json':
-            data = json.loads(text)
-            if isinstance(data, list):
-                items = [str(item) for item in data]
-            elif isinstance(data, dict):
-                # ищем первый список в значениях
-                for v in data.values():
-                    if isinstance(v, list):
-                        items = [str(item) for item in v]
-                        break
-                else:
-                    raise ValueError('JSON не содержит список доменов')
-            else:
-                raise ValueError('JSON должен быть списком или словарём со списком')
+        return list(DomainReader.iter(path))
+
+    @staticmethod
+    def iter(path: Path) -> Iterator[str]:
+        """Отдаёт домены по одному, не загружая файл целиком в память"""
+        suffix = path.suffix.lower()
+        if suffix == '.txt':
+            items = DomainReader._iter_txt(path)
+        elif suffix == '.json':
+            items = DomainReader._iter_json(path)
         else:
             raise ValueError('Поддерживаются только файлы .txt или .json')
+        for raw in items:
+            yield DomainReader._extract_domain(raw)
 
-        return [DomainReader._extract_domain(raw) for raw in items]
+    @staticmethod
+    def _iter_txt(path: Path) -> Iterator[str]:
+        with path.open('r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield line
+
+    @staticmethod
+    def _iter_json(path: Path) -> Iterator[str]:
+        # Большой JSON-список читаем инкрементально через ijson, если он установлен
+        if ijson is not None and path.stat().st_size > JSON_STREAM_MIN_BYTES:
+            with path.open('rb') as f:
+                if f.read(1024).lstrip(b'\xef\xbb\xbf \t\r\n').startswith(b'['):
+                    f.seek(0)
+                    for item in ijson.items(f, 'item'):
+                        yield str(item)
+                    return
+        data = json.loads(path.read_text(encoding='utf-8'))
+        if isinstance(data, list):
+            items = data
+        elif isinstance(data, dict):
+            # ищем первый список в значениях
+            for v in data.values():
+                if isinstance(v, list):
+                    items = v
+                    break
+            else:
+                raise ValueError('JSON не содержит список доменов')
+        else:
+            raise ValueError('JSON должен быть списком или словарём со списком')
+        for item in items:
+            yield str(item)
 
     @staticmethod
     def _extract_domain(raw: str) -> str:
+        # Быстрый путь для "domain" и "scheme://host/...", urlparse — только для остального
+        m = _DOMAIN_RE.match(raw.strip())
+        if m:
+            return m.group(1)
         parsed = urlparse(raw if '://' in raw else f'//{raw}', scheme='')
         netloc = parsed.netloc or parsed.path
         return netloc.split(':')[0]
 
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def resolve(domain: str) -> str:
+        """IPv4-адрес домена; если не резолвится, возвращает сам домен"""
+        try:
+            return socket.getaddrinfo(domain, None, socket.AF_INET)[0][4][0]
+        except (OSError, UnicodeError):
+            return domain
 
-class ApiClient:
-    """Клиент для запросов к внешнему API с поддержкой retry"""
 
-    def __init__(self):
-        self.session = requests.Session()
-        retries = Retry(total=3, backoff_factor=0.5, status_forcelist=[500, 502, 503, 504])
-        adapter = HTTPAdapter(max_retries=retries)
-        self.session.mount('http://', adapter)
-        self.session.mount('https://', adapter)
+class ApiClient:
+    """Обёртка над reqapi: сессии и retry живут в общем экземпляре reqapi"""
 
-    def lookup(self, api, domain: str) -> Optional[Dict[str, str]]:
+    def lookup_batch(self, api, targets: List[str]) -> Dict[str, Dict[str, str]]:
+        """Один запрос к ip-api.com/batch на весь список, ответ API по каждому адресу"""
         thread = threading.current_thread().name
-        logging.debug(f"[{thread}] [LOOKUP] Start lookup for {domain}")
+        logging.debug(f"[{thread}] [LOOKUP] Start batch lookup for {len(targets)} targets")
         try:
-            res = api.reqapi_ia_get_result(domain)
-            logging.debug(f"[{thread}] [LOOKUP] Received status={res.get('status')} for {domain}")
+            res_list = api.reqapi_ia_get_batch(targets)
         except Exception as e:
-            logging.warning(f"[{thread}] [API] Exception for {domain}: {e}")
-            return None
+            logging.warning(f"[{thread}] [API] Exception for batch of {len(targets)}: {e}")
+            res_list = []
+        if not isinstance(res_list, list) or len(res_list) != len(targets):
+            logging.warning(f"[{thread}] [API] Некорректный ответ batch для {len(targets)} адресов")
+            res_list = [{}] * len(targets)
+        return dict(zip(targets, res_list))
 
+    @staticmethod
+    def to_record(domain: str, res: Dict[str, str]) -> Optional[Dict[str, str]]:
+        thread = threading.current_thread().name
         if res.get('status') != 'success':
             logging.debug(f"[{thread}] [LOOKUP] Unsuccessful status for {domain}, skipping")
             logging.info(f"[API] Неуспешный статус для {domain}")
@@ -116,12 +176,21 @@ class TelegramNotifier:
         self.chat_id = chat_id
         self.base_url = f'https://api.telegram.org/bot{token}'
         self.session = requests.Session()
+        # Один фоновый поток: отправки идут по порядку и не держат основной поток
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='telegram')
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        return self._executor.submit(fn, *args, **kwargs)
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=True)
 
     def send_message(self, message: str) -> None:
         url = f"{self.base_url}/sendMessage"
         payload = {'chat_id': self.chat_id, 'text': message}
         try:
             self.session.post(url, data=payload, timeout=10)
+            logging.info('📤 Уведомление отправлено')
         except Exception as e:
             logging.error(f'[Telegram] Ошибка отправки сообщения: {e}')
 
@@ -129,9 +198,19 @@ class TelegramNotifier:
         url = f"{self.base_url}/sendDocument"
         try:
             with file_path.open('rb') as f:
-                files = {'document': f}
-                data = {'chat_id': self.chat_id, 'caption': caption}
-                self.session.post(url, data=data, files=files, timeout=30)
+                if MultipartEncoder is not None:
+                    # Потоковая загрузка: файл не собирается в памяти целиком
+                    enc = MultipartEncoder(fields={
+                        'chat_id': self.chat_id,
+                        'caption': caption,
+                        'document': (file_path.name, f, 'text/csv'),
+                    })
+                    self.session.post(url, data=enc, headers={'Content-Type': enc.content_type}, timeout=30)
+                else:
+                    files = {'document': f}
+                    data = {'chat_id': self.chat_id, 'caption': caption}
+                    self.session.post(url, data=data, files=files, timeout=30)
+            logging.info('📤 Файл отправлен')
         except Exception as e:
             logging.error(f'[Telegram] Ошибка отправки файла: {e}')
 
@@ -143,11 +222,9 @@ class BatchIpLookup:
         self.input_path = input_path
         self.workers = workers
         self.api = self._load_api()
-        self.session = requests.Session()
         self.notifier = None
 
     def _load_api(self):
-        from src.script.reqapi import reqapi
         return reqapi()
 
     def _setup_notifier(self):
@@ -156,50 +233,66 @@ class BatchIpLookup:
 
     def run(self):
         logging.info('🚀 Запуск batch_ip_lookup')
-        domains = DomainReader.read(self.input_path)
+        # Дубликаты не запрашиваем повторно, порядок первого вхождения сохраняется
+        domains = list(dict.fromkeys(DomainReader.iter(self.input_path)))
         total = len(domains)
         logging.info(f'📑 Всего доменов: {total}, воркеры: {self.workers}')
-        # Prepare results file with header
+        # Prepare results file path
         RESULTS_DIR.mkdir(exist_ok=True)
         run_id = uuid.uuid4().hex[:8]
         now = datetime.now()
         date_str = now.strftime('%Y%m%d')
         time_str = now.strftime('%H%M%S')
         output_path = RESULTS_DIR / f'results_{run_id}_{date_str}_{time_str}.csv'
-        # Write header only
-        pd.DataFrame([], columns=['domain','country','isp','organization','as']) \
-          .to_csv(output_path, index=False, encoding='utf-8-sig')
-        # Process in chunks
-        for start in range(0, total, CHUNK_SIZE):
-            end = min(start + CHUNK_SIZE, total)
-            chunk = domains[start:end]
-            logging.info(f'🔄 Обработка доменов {start+1}-{end} из {total}')
-            records = []
-            with ThreadPoolExecutor(max_workers=self.workers) as executor:
-                futures = {executor.submit(ApiClient().lookup, self.api, d): d for d in chunk}
-                for idx, future in enumerate(as_completed(futures), start=start+1):
-                    domain = futures[future]
-                    result = future.result()
+        # One client for the whole run: each worker keeps its own reqapi session
+        lookup_batch = partial(ApiClient().lookup_batch, self.api)
+        # Single CSV writer and one pool for the whole run; each task is one
+        # ip-api /batch request, the pool overlaps network with CSV writes
+        with output_path.open('w', newline='', encoding='utf-8-sig') as f, \
+                ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='lookup') as executor:
+            writer = csv.DictWriter(f, fieldnames=CSV_FIELDS)
+            writer.writeheader()
+            # Домены с общим IP запрашиваем у ip-api один раз
+            with ThreadPoolExecutor(max_workers=RESOLVE_WORKERS, thread_name_prefix='resolve') as resolver:
+                domain_ips = list(resolver.map(DomainReader.resolve, domains))
+            ips = list(dict.fromkeys(domain_ips))
+            logging.info(f'🌐 Уникальных адресов: {len(ips)}')
+            starts = range(0, len(ips), CHUNK_SIZE)
+            chunks = [ips[start:start + CHUNK_SIZE] for start in starts]
+            # map отдаёт результаты в порядке чанков, без словаря future -> чанк
+            ip_results: Dict[str, Dict[str, str]] = {}
+            pos = 0
+            for start, chunk, results in zip(starts, chunks, executor.map(lookup_batch, chunks)):
+                logging.info(f'🔄 Обработка адресов {start+1}-{start+len(chunk)} из {len(ips)}')
+                ip_results.update(results)
+                # Пишем строки в порядке входного файла, как только известен ответ по IP домена
+                while pos < total and domain_ips[pos] in ip_results:
+                    domain, ip = domains[pos], domain_ips[pos]
+                    pos += 1
+                    result = ApiClient.to_record(domain, ip_results[ip])
                     if result:
-                        records.append(result)
+                        writer.writerow(result)
                         icon = '✅'
                     else:
                         icon = '❌'
-                    logging.info(f"{icon} [{idx}/{total}] {domain}")
-            # Append chunk results without header
-            pd.DataFrame(records, columns=['domain','country','isp','organization','as']) \
-              .to_csv(output_path, mode='a', index=False, header=False, encoding='utf-8-sig')
-            logging.info(f'✅ Чанк {start+1}-{end} сохранён')
+                    logging.info(f"{icon} [{pos}/{total}] {domain}")
+                # Every batch is durable as soon as it is written
+                f.flush()
+                logging.info(f'✅ Чанк {start+1}-{start+len(chunk)} сохранён')
         logging.info(f'🎉 Все чанки обработаны, результаты в {output_path}')
+        stats = self.api.reqapi_ia_stats()
+        logging.info(f"📊 Ответы ip-api: 200={stats['ok']}, 429={stats['rate_limited']}, прочие={stats['error']}")
         # Send notifications if any
         if self.notifier:
             msg = f'Batch ip-lookup завершён. Файл: {output_path.name}'
-            logging.info('📤 Отправка уведомления в Telegram...')
-            self.notifier.send_message(msg)
-            logging.info('📤 Уведомление отправлено')
-            logging.info('📤 Отправка файла в Telegram...')
-            self.notifier.send_file(output_path, caption=msg)
-            logging.info('📤 Файл отправлен')
+            logging.info('📤 Отправка уведомления и файла в Telegram в фоне...')
+            self.notifier.submit(self.notifier.send_message, msg)
+            self.notifier.submit(self.notifier.send_file, output_path, caption=msg)
+
+    def close(self):
+        # Дожидаемся фоновых отправок в Telegram перед выходом
+        if self.notifier:
+            self.notifier.shutdown()
 
 
 def parse_args():
@@ -227,6 +320,9 @@ if __name__ == '__main__':
     fh.setFormatter(logging.Formatter(LOG_FORMAT))
     logger.addHandler(fh)
 
+    # reqapi's DEBUG traces (full response bodies) stay off unless asked for
+    logging.getLogger('src.script.reqapi').setLevel(REQAPI_LOG_LEVEL)
+
     args = parse_args()
     input_path = Path(args.input)
     if not input_path.exists():
@@ -237,6 +333,7 @@ if __name__ == '__main__':
         app = BatchIpLookup(input_path, args.workers)
         app._setup_notifier()
         app.run()
+        app.close()
     except Exception as e:
         logging.exception(f'Ошибка выполнения: {e}')
         sys.exit(1)
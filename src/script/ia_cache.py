@@ -0,0 +1,89 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+# Кэш ответов ip-api.com: путь и время жизни записи (сек), 0 — кэш выключен
+IA_CACHE_PATH = os.getenv('IA_CACHE_PATH', '.ia_cache.sqlite3')
+IA_CACHE_TTL_DEFAULT = 24 * 60 * 60
+
+
+def _parse_ttl(value: str | None) -> int:
+    if value is None:
+        return IA_CACHE_TTL_DEFAULT
+    try:
+        return int(value)
+    except ValueError:
+        log.warning("[IA_CACHE] Неверный IA_CACHE_TTL=%r, используем %s", value, IA_CACHE_TTL_DEFAULT)
+        return IA_CACHE_TTL_DEFAULT
+
+
+IA_CACHE_TTL = _parse_ttl(os.getenv('IA_CACHE_TTL'))
+
+
+class ia_cache():
+    """
+    Persistent sqlite cache of successful ip-api.com answers, keyed by target (domain or IP).
+    One connection shared by all threads, guarded by a lock; opened on first use.
+    Any sqlite error is logged and treated as a cache miss / skipped write.
+    """
+    def __init__(self, path: str = IA_CACHE_PATH, ttl: int = IA_CACHE_TTL):
+        super(ia_cache, self).__init__()
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connect(self) -> sqlite3.Connection:
+        # Caller holds self._lock
+        if self._conn is None:
+            try:
+                conn = sqlite3.connect(self.path, check_same_thread=False)
+                with conn:
+                    conn.execute(
+                        "CREATE TABLE IF NOT EXISTS ia_cache "
+                        "(target TEXT PRIMARY KEY, ts INTEGER, payload BLOB)")
+            except sqlite3.Error:
+                # Файл кэша недоступен: выключаем кэш до конца работы
+                self.ttl = 0
+                raise
+            self._conn = conn
+        return self._conn
+
+    def get_many(self, targets: list[str]) -> dict[str, dict]:
+        if self.ttl <= 0 or not targets:
+            return {}
+        placeholders = ",".join("?" * len(targets))
+        try:
+            with self._lock:
+                rows = self._connect().execute(
+                    f"SELECT target, payload FROM ia_cache WHERE ts >= ? AND target IN ({placeholders})",
+                    (int(time.time()) - self.ttl, *targets)).fetchall()
+        except sqlite3.Error as e:
+            log.warning("[IA_CACHE] Ошибка чтения кэша %s: %s", self.path, e)
+            return {}
+        return {target: json.loads(payload) for target, payload in rows}
+
+    def get(self, target: str) -> dict | None:
+        return self.get_many([target]).get(target)
+
+    def set_many(self, items: dict[str, dict]) -> None:
+        if self.ttl <= 0 or not items:
+            return
+        now = int(time.time())
+        try:
+            with self._lock:
+                conn = self._connect()
+                with conn:
+                    conn.executemany(
+                        "INSERT OR REPLACE INTO ia_cache (target, ts, payload) VALUES (?, ?, ?)",
+                        [(target, now, json.dumps(payload)) for target, payload in items.items()])
+        except sqlite3.Error as e:
+            log.warning("[IA_CACHE] Ошибка записи в кэш %s: %s", self.path, e)
+
+    def set(self, target: str, payload: dict) -> None:
+        self.set_many({target: payload})
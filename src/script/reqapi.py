@@ -1,70 +1,222 @@
-import json
 import time
+import socket
+import logging
 import requests
 import threading
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from urllib3.util.retry import Retry
 
-# Global rate-limit control
-_rate_limit_lock = threading.Lock()
+from src.script.ia_cache import ia_cache
+
+# orjson is optional: noticeably faster on batch responses, stdlib json otherwise
+try:
+    from orjson import loads as _json_loads
+except ImportError:
+    from json import loads as _json_loads
+
+log = logging.getLogger(__name__)
+
+# Global rate-limit control: waiting threads block on the condition
+# until _next_allowed_time has passed
+_rate_cv = threading.Condition()
 _next_allowed_time = 0.0
 
+# ip-api.com: не больше 45 запросов в минуту на IP
+IA_RATE_LIMIT = 45
+IA_RATE_PERIOD = 60.0
+# ip-api.com/batch: не больше 15 запросов в минуту, до 100 адресов в запросе
+IA_BATCH_RATE_LIMIT = 15
+IA_BATCH_MAX_SIZE = 100
+
+
+class _TokenBucket():
+    """
+    Client-side token bucket: paces requests to `capacity` per `period` seconds.
+    """
+    def __init__(self, capacity: int, period: float):
+        self._lock = threading.Lock()
+        self._capacity = float(capacity)
+        self._rate_per_sec = capacity / period
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate_per_sec)
+        self._updated = now
+
+    def acquire(self) -> None:
+        while True:
+            with self._lock:
+                self._refill(time.monotonic())
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                sleep_for = (1 - self._tokens) / self._rate_per_sec
+            # Sleep outside the lock so other threads can refill/inspect
+            log.debug("[RATE_LIMIT] Нет токенов, ждем %.2fs", sleep_for)
+            time.sleep(sleep_for)
+
+    def drain(self) -> None:
+        with self._lock:
+            self._tokens = 0.0
+            self._updated = time.monotonic()
+
+
+class _KeepAliveAdapter(HTTPAdapter):
+    """
+    HTTPAdapter whose pooled sockets use TCP_NODELAY and SO_KEEPALIVE.
+    """
+    # urllib3 defaults already carry TCP_NODELAY; add SO_KEEPALIVE on top
+    socket_options = HTTPConnection.default_socket_options + [
+        (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+    ]
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs.setdefault("socket_options", self.socket_options)
+        super().init_poolmanager(*args, **kwargs)
+
+
 class reqapi():
     def __init__(self):
         super(reqapi, self).__init__()
+        # Keep-alive session per worker thread, so threads don't contend on one urllib3 pool
+        self._tls = threading.local()
+        self._ia_bucket = _TokenBucket(IA_RATE_LIMIT, IA_RATE_PERIOD)
+        self._ia_batch_bucket = _TokenBucket(IA_BATCH_RATE_LIMIT, IA_RATE_PERIOD)
+        self._ia_cache = ia_cache()
+        # Постоянные части запросов к ip-api, собираются один раз
+        self._ia_base = "http://ip-api.com/json/"
+        self._ia_params = {"fields": "status,message,country,isp,org,as"}
+        self._ia_batch_url = "http://ip-api.com/batch"
+        self._ia_batch_params = {"fields": "status,message,country,isp,org,as,query"}
+        # Счётчики ответов ip-api: проверка, что rate-limit действительно работает
+        self._ia_stats_lock = threading.Lock()
+        self._ia_stats = {"ok": 0, "rate_limited": 0, "error": 0}
+
+    def _build_session(self) -> requests.Session:
+        session = requests.Session()
+        retries = Retry(total=3, backoff_factor=0.5, status_forcelist=[500, 502, 503, 504])
+        adapter = _KeepAliveAdapter(max_retries=retries)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def _session(self) -> requests.Session:
+        session = getattr(self._tls, "session", None)
+        if session is None:
+            session = self._tls.session = self._build_session()
+        return session
 
     def _wait_for_rate_limit(self):
         """
         Before sending a request, ensure we are past the global next allowed time.
         """
-        global _next_allowed_time
-        with _rate_limit_lock:
-            now = time.time()
-            if now < _next_allowed_time:
-                wait = _next_allowed_time - now
-                print(f"[DEBUG][RATE_LIMIT] Глобальный лимит, ждем {wait:.2f}s")
-        # Sleep outside the lock to allow others to check
-        if now < _next_allowed_time:
-            time.sleep(wait)
+        with _rate_cv:
+            while (delay := _next_allowed_time - time.time()) > 0:
+                log.debug("[RATE_LIMIT] Глобальный лимит, ждем %.2fs", delay)
+                _rate_cv.wait(timeout=delay)
 
-    def _handle_rate_limit(self, headers: dict) -> None:
+    def _handle_rate_limit(self, headers: dict, bucket: _TokenBucket | None = None) -> None:
         """
         Если заголовок X-Rl присутствует, выводим оставшееся число запросов.
-        Если X-Rl == 0, ждем X-Ttl секунд перед следующими запросами.
+        Если X-Rl == 0, откладываем следующие запросы на X-Ttl секунд.
         """
-        # Accept header names in any case
-        rl = headers.get('X-Rl') or headers.get('X-RL') or headers.get('x-rl')
-        ttl = headers.get('X-Ttl') or headers.get('X-TTL') or headers.get('x-ttl')
-        try:
-            remaining = int(rl) if rl is not None else None
-            wait = int(ttl) if ttl is not None else 0
-        except ValueError:
-            print(f"[DEBUG][RATE_LIMIT] Неверный формат заголовков X-Rl/X-Ttl: {rl}/{ttl}")
+        # resp.headers is a CaseInsensitiveDict, one lookup per header is enough
+        rl = headers.get('X-Rl')
+        ttl = headers.get('X-Ttl')
+        if rl is None and ttl is None:
+            return
+        if (rl is not None and not rl.isdigit()) or (ttl is not None and not ttl.isdigit()):
+            log.debug("[RATE_LIMIT] Неверный формат заголовков X-Rl/X-Ttl: %s/%s", rl, ttl)
             return
+        remaining = int(rl) if rl is not None else None
+        wait = int(ttl) if ttl is not None else 0
 
         if remaining is not None:
-            print(f"[DEBUG][RATE_LIMIT] Осталось запросов: {remaining}, до сброса: {wait}s")
+            log.debug("[RATE_LIMIT] Осталось запросов: %s, до сброса: %ss", remaining, wait)
+        if remaining == 0 and bucket is not None:
+            # Server says the window is spent: start refilling from zero
+            bucket.drain()
         if remaining == 0 and wait > 0:
-            # Set global next allowed time
+            # Set global next allowed time; threads block in _wait_for_rate_limit
             global _next_allowed_time
-            with _rate_limit_lock:
+            with _rate_cv:
                 _next_allowed_time = time.time() + wait
-            print(f"[DEBUG][RATE_LIMIT] Лимит исчерпан, ждем {wait} сек...")
-            time.sleep(wait)
+                _rate_cv.notify_all()
+            log.debug("[RATE_LIMIT] Лимит исчерпан, ждем %s сек...", wait)
+
+    def _count_ia_response(self, status_code: int) -> None:
+        key = "ok" if status_code == 200 else "rate_limited" if status_code == 429 else "error"
+        with self._ia_stats_lock:
+            self._ia_stats[key] += 1
+
+    def reqapi_ia_stats(self) -> dict[str, int]:
+        """
+        Сколько ответов ip-api было успешными, 429 и прочими ошибками
+        """
+        with self._ia_stats_lock:
+            return dict(self._ia_stats)
 
     def reqapi_ia_get_result(self, target: str) -> dict:
         """
-        Debug + rate-limit для ip-api.com
+        Debug + rate-limit + кэш для ip-api.com
         """
+        cached = self._ia_cache.get(target)
+        if cached is not None:
+            log.debug("[IA_GET] Cache hit: %s", target)
+            return cached
         self._wait_for_rate_limit()
-        url = f"http://ip-api.com/json/{target}?fields=status,message,country,isp,org,as"
-        print(f"[DEBUG][IA_GET] URL: {url}")
+        self._ia_bucket.acquire()
+        url = self._ia_base + target
+        log.debug("[IA_GET] URL: %s | params: %s", url, self._ia_params)
         try:
-            resp = requests.get(url, timeout=10)
-            print(f"[DEBUG][IA_GET] HTTP {resp.status_code} — body:\n{resp.text}\n")
-            self._handle_rate_limit(resp.headers)
-            return resp.json()
+            resp = self._session().get(url, params=self._ia_params, timeout=10)
+            self._count_ia_response(resp.status_code)
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("[IA_GET] HTTP %s — body:\n%s\n", resp.status_code, resp.text)
+            self._handle_rate_limit(resp.headers, self._ia_bucket)
+            res = _json_loads(resp.content)
         except Exception as e:
-            print(f"[DEBUG][IA_GET] Ошибка при запросе {url}: {e}")
+            log.warning("[IA_GET] Ошибка при запросе %s: %s", url, e)
             return {}
+        if res.get("status") == "success":
+            self._ia_cache.set(target, res)
+        return res
+
+    def reqapi_ia_get_batch(self, targets: list[str]) -> list[dict]:
+        """
+        Debug + rate-limit + кэш для ip-api.com/batch: промахи кэша уходят POST-ами
+        по IA_BATCH_MAX_SIZE адресов, ответы идут в том же порядке, что и targets
+        """
+        cached = self._ia_cache.get_many(targets)
+        missing = [target for target in targets if target not in cached]
+        log.debug("[IA_BATCH] Cache hits: %s/%s", len(targets) - len(missing), len(targets))
+        fetched = {}
+        # ip-api отклоняет batch больше IA_BATCH_MAX_SIZE адресов
+        for start in range(0, len(missing), IA_BATCH_MAX_SIZE):
+            part = missing[start:start + IA_BATCH_MAX_SIZE]
+            fetched.update(zip(part, self._ia_post_batch(part)))
+        self._ia_cache.set_many({target: res for target, res in fetched.items()
+                                 if isinstance(res, dict) and res.get("status") == "success"})
+        return [cached.get(target) or fetched.get(target, {}) for target in targets]
+
+    def _ia_post_batch(self, targets: list[str]) -> list[dict]:
+        self._wait_for_rate_limit()
+        self._ia_batch_bucket.acquire()
+        url = self._ia_batch_url
+        log.debug("[IA_BATCH] URL: %s | params: %s | targets: %s", url, self._ia_batch_params, len(targets))
+        try:
+            resp = self._session().post(url, params=self._ia_batch_params, json=targets, timeout=10)
+            self._count_ia_response(resp.status_code)
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("[IA_BATCH] HTTP %s — body:\n%s\n", resp.status_code, resp.text)
+            self._handle_rate_limit(resp.headers, self._ia_batch_bucket)
+            res_list = _json_loads(resp.content)
+        except Exception as e:
+            log.warning("[IA_BATCH] Ошибка при запросе %s: %s", url, e)
+            return []
+        return res_list if isinstance(res_list, list) else []
 
     def reqapi_ch_post_request(self, target: str) -> str:
         """
@@ -73,14 +225,15 @@ class reqapi():
         self._wait_for_rate_limit()
         url = "https://check-host.net/ip-info/whois"
         data = {"host": target}
-        print(f"[DEBUG][CH_POST] URL: {url} | data: {data}")
+        log.debug("[CH_POST] URL: %s | data: %s", url, data)
         try:
-            resp = requests.post(url, data=data, timeout=10)
-            print(f"[DEBUG][CH_POST] HTTP {resp.status_code} — body:\n{resp.text}\n")
+            resp = self._session().post(url, data=data, timeout=10)
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("[CH_POST] HTTP %s — body:\n%s\n", resp.status_code, resp.text)
             self._handle_rate_limit(resp.headers)
             return resp.text
         except Exception as e:
-            print(f"[DEBUG][CH_POST] Ошибка при POST {url}: {e}")
+            log.warning("[CH_POST] Ошибка при POST %s: %s", url, e)
             return ""
 
     def reqapi_ch_get_request(self, target: str, method: str, max_nodes: int) -> dict:
@@ -90,14 +243,15 @@ class reqapi():
         self._wait_for_rate_limit()
         url = f"https://check-host.net/check-{method}?host={target}&max_nodes={max_nodes}"
         headers = {"Accept": "application/json"}
-        print(f"[DEBUG][CH_GET_REQ] URL: {url} | headers: {headers}")
+        log.debug("[CH_GET_REQ] URL: %s | headers: %s", url, headers)
         try:
-            resp = requests.get(url, headers=headers, timeout=10)
-            print(f"[DEBUG][CH_GET_REQ] HTTP {resp.status_code} — body:\n{resp.text}\n")
+            resp = self._session().get(url, headers=headers, timeout=10)
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("[CH_GET_REQ] HTTP %s — body:\n%s\n", resp.status_code, resp.text)
             self._handle_rate_limit(resp.headers)
-            return resp.json()
+            return _json_loads(resp.content)
         except Exception as e:
-            print(f"[DEBUG][CH_GET_REQ] Ошибка при GET {url}: {e}")
+            log.warning("[CH_GET_REQ] Ошибка при GET %s: %s", url, e)
             return {}
 
     def reqapi_ch_get_result(self, request_id: int) -> dict:
@@ -106,12 +260,13 @@ class reqapi():
         """
         self._wait_for_rate_limit()
         url = f"https://check-host.net/check-result/{request_id}"
-        print(f"[DEBUG][CH_GET_RES] URL: {url}")
+        log.debug("[CH_GET_RES] URL: %s", url)
         try:
-            resp = requests.get(url, timeout=10)
-            print(f"[DEBUG][CH_GET_RES] HTTP {resp.status_code} — body:\n{resp.text}\n")
+            resp = self._session().get(url, timeout=10)
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("[CH_GET_RES] HTTP %s — body:\n%s\n", resp.status_code, resp.text)
             self._handle_rate_limit(resp.headers)
-            return resp.json()
+            return _json_loads(resp.content)
         except Exception as e:
-            print(f"[DEBUG][CH_GET_RES] Ошибка при GET {url}: {e}")
+            log.warning("[CH_GET_RES] Ошибка при GET %s: %s", url, e)
             return {}